@@ -3,30 +3,69 @@ Gamma API 调用工具
 将文本内容或 PDF 发送给 Gamma，生成 PPT 并导出为 PDF
 """
 import os
+import re
+import sys
+import atexit
 import time
+import random
+import shutil
+import threading
 import json
 import hashlib
+import mmap
+import zipfile
+import tempfile
 import requests
+from contextlib import contextmanager
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
 from pathlib import Path
 from dotenv import load_dotenv
 from docx import Document
-import PyPDF2
+from lxml import etree
 from datetime import datetime
 
-# Selenium 相关导入（可选，用于浏览器自动化）
+# PDF 解析：优先使用仍在维护的 pypdf，未安装时退回 PyPDF2
 try:
-    from selenium import webdriver
-    from selenium.webdriver.common.by import By
-    from selenium.webdriver.support.ui import WebDriverWait
-    from selenium.webdriver.support import expected_conditions as EC
-    from selenium.webdriver.chrome.service import Service
-    from selenium.webdriver.chrome.options import Options
-    from webdriver_manager.chrome import ChromeDriverManager
-    SELENIUM_AVAILABLE = True
+    from pypdf import PdfReader
 except ImportError:
-    SELENIUM_AVAILABLE = False
-    print("警告: Selenium 未安装，浏览器自动化功能将不可用")
-    print("如需使用浏览器自动化导出，请运行: pip install selenium webdriver-manager")
+    from PyPDF2 import PdfReader
+
+# pypdfium2（可选，基于原生 PDFium 库提取 PDF 文本，比纯 Python 的 pypdf 快得多；
+# 未安装或解析失败时退回 pypdf）
+try:
+    import pypdfium2
+    PDFIUM_AVAILABLE = True
+except ImportError:
+    PDFIUM_AVAILABLE = False
+
+# Selenium 相关模块（可选，用于浏览器自动化）
+# 只有真正需要浏览器导出时才由 _ensure_selenium() 导入，API 导出成功时不产生导入开销
+SELENIUM_AVAILABLE = None  # None 表示尚未检查
+webdriver = By = WebDriverWait = EC = Service = Options = ChromeDriverManager = None
+
+# orjson（可选，更快的 JSON 解析/序列化；未安装时使用标准库 json）
+try:
+    import orjson
+    ORJSON_AVAILABLE = True
+except ImportError:
+    ORJSON_AVAILABLE = False
+
+# MessagePack + zstd（可选，用于记录的二进制快照，加载更快、体积更小）
+try:
+    import msgpack
+    import zstandard
+    BINARY_RECORDS_AVAILABLE = True
+except ImportError:
+    BINARY_RECORDS_AVAILABLE = False
+
+# tiktoken（可选，按 token 数精确截断过长的输入文本；未安装时按字符数粗略估算）
+try:
+    import tiktoken
+    TIKTOKEN_AVAILABLE = True
+except ImportError:
+    TIKTOKEN_AVAILABLE = False
 
 # 加载环境变量
 load_dotenv()
@@ -35,14 +74,295 @@ load_dotenv()
 GAMMA_API_KEY = os.getenv("GAMMA_API_KEY")
 GAMMA_THEME_ID = os.getenv("GAMMA_THEME_ID")  # 可选：如果未设置则使用工作区默认主题
 GAMMA_API_BASE_URL = "https://public-api.gamma.app/v1.0"
+# Gamma 网页应用地址（导出备用端点所在主机）
+GAMMA_APP_BASE_URL = "https://gamma.app"
+
+# 批量处理（--all）时同时处理的最大文件数，避免触发 Gamma API 限流（至少为 1，无效值使用默认值 4）
+try:
+    MAX_CONCURRENT_FILES = max(1, int(os.getenv("GAMMA_MAX_CONCURRENCY", "4")))
+except ValueError:
+    print(f"警告: GAMMA_MAX_CONCURRENCY 不是有效的整数（{os.getenv('GAMMA_MAX_CONCURRENCY')}），使用默认值 4")
+    MAX_CONCURRENT_FILES = 4
+
+# 共享 HTTP 会话：复用 TCP/TLS 连接（轮询状态时无需每次重新握手），
+# 并对限流和临时性服务端错误自动退避重试。
+# urllib3 默认不重试 POST，因此不会重复创建生成任务。
+_SESSION = requests.Session()
+# 每个并发处理的文件可能同时占用同一主机的多个连接（状态轮询、导出端点探测、连接预热），
+# 连接池按并发数放大，避免连接用完后被丢弃、下次请求重新握手
+_SESSION.mount("https://", HTTPAdapter(
+    pool_connections=4,
+    pool_maxsize=max(8, MAX_CONCURRENT_FILES * 2),
+    max_retries=Retry(
+        total=3,
+        backoff_factor=0.5,
+        status_forcelist=[429, 500, 502, 503, 504],
+        raise_on_status=False,  # 重试耗尽后返回最后的响应，由调用方按状态码处理
+    ),
+))
+if GAMMA_API_KEY:
+    _SESSION.headers["X-API-KEY"] = GAMMA_API_KEY
+
+# 生成状态轮询：每次间隔乘以该系数，并附加最多 POLL_JITTER 秒的随机抖动
+POLL_BACKOFF_FACTOR = 1.6
+POLL_JITTER = 0.5
+
+# 生成请求中固定不变的参数（根据官方文档：https://developers.gamma.app/docs/generate-api-parameters-explained）
+# generate_presentation() 每次只合并动态字段；嵌套字典在各次请求间共享，不要原地修改
+_PAYLOAD_TEMPLATE = {
+    # 必需参数
+    "textMode": "generate",
+    "format": "presentation",
+    "cardSplit": "auto",
+    "exportAs": "pdf",
+    # 文本选项
+    "textOptions": {
+        "amount": "detailed",  # 可选: "brief", "medium", "detailed"
+        "tone": "professional",  # 可选: 一个或多个词，1-500字符
+        "audience": "general",  # 可选: 一个或多个词，1-500字符，描述目标受众
+        "language": "en"  # 可选: 默认 "en"，支持多种语言
+    },
+    # 卡片选项
+    # cardOptions 支持 dimensions 和 headerFooter，不支持 size、includeHeader、includeFooter
+    "cardOptions": {
+        "dimensions": "fluid"  # 可选: "fluid"(默认), "16x9", "4x3" (format 为 presentation 时)
+        # headerFooter 是可选的，如果需要可以添加，例如：
+        # "headerFooter": {
+        #     "topRight": {
+        #         "type": "image",
+        #         "source": "themeLogo",
+        #         "size": "sm"
+        #     },
+        #     "bottomRight": {
+        #         "type": "cardNumber"
+        #     },
+        #     "hideFromFirstCard": true,
+        #     "hideFromLastCard": false
+        # }
+    },
+}
+
+# 图像选项
+# source 可选: "aiGenerated"(默认), "pictographic", "unsplash", "giphy", "webAllImages", "webFreeToUse", "webFreeToUseCommercially", "placeholder", "noImages"
+# model 和 style 仅在 source 为 "aiGenerated" 时相关
+_IMAGE_OPTIONS_AI_GENERATED = {
+    "source": "aiGenerated",
+    "model": "imagen-4-pro",
+    "style": "photorealistic",
+}
+_IMAGE_OPTIONS_NO_IMAGES = {
+    "source": "noImages",
+}
 
 # 目录配置
 DATASET_DIR = Path("dataset")
 OUTPUT_DIR = Path("output")
 OUTPUT_DIR.mkdir(exist_ok=True)
+# 浏览器导出的下载暂存目录：浏览器只下载到这里，完成后再移动到 OUTPUT_DIR，
+# 不会误把其他文件（例如并发处理时其他文件通过 API 下载的结果）当成本次下载
+BROWSER_DOWNLOAD_DIR = OUTPUT_DIR / ".browser_downloads"
 
 # 记录文件路径
 RECORDS_FILE = Path("generation_records.json")
+# 记录的二进制快照（zstd 压缩的 MessagePack），可用时优先从它加载；
+# RECORDS_FILE 仍同步写入，作为便于查看的 JSON 版本
+RECORDS_BINARY_FILE = Path("generation_records.msgpack.zst")
+# 记录增量日志（JSONL，每行一次修改），定期合并回 RECORDS_FILE
+RECORDS_LOG_FILE = Path("generation_records.log")
+# 日志大小超过快照大小的该倍数（且不小于最小值）时进行压缩
+RECORDS_COMPACT_RATIO = 4
+RECORDS_COMPACT_MIN_SIZE = 64 * 1024
+
+# 计算文件哈希时的读取块大小（1 MiB）
+HASH_CHUNK_SIZE = 1 << 20
+
+# 文件哈希缓存: (绝对路径, st_mtime_ns, st_size) -> 哈希值
+# 文件修改后 mtime/size 变化，缓存自然失效
+_HASH_CACHE = {}
+
+# 图片链接识别（预编译，避免每次调用重复编译和构建列表）
+_URL_CHARS = r'[^\s<>"{}|\\^`\[\]]'
+_URL_RE = re.compile(rf'https?://{_URL_CHARS}+')
+_IMG_EXTS = ('.jpg', '.jpeg', '.png', '.gif', '.webp', '.svg', '.bmp')
+# PDF 只按扩展名识别图片链接（不含 .bmp）
+_PDF_IMG_EXTS = ('.jpg', '.jpeg', '.png', '.gif', '.webp', '.svg')
+_IMG_DOMAINS = ('imgur.com', 'imgbb.com', 'cloudinary.com', 'unsplash.com', 'pexels.com')
+# 图片链接识别分两步：先用 _URL_RE 线性扫描出候选 URL，再逐个判断是否为图片链接。
+# 不要把判断并入同一个正则：前瞻/回溯在一长串相连的 URL 字符上会退化为平方复杂度
+# PDF 图片链接：URL 中某处以图片扩展名结尾，且其后为 URL 结尾或 ?query / #fragment。
+# 只在单个候选 URL 上 search，每个位置都是定长比较，耗时与 URL 长度成线性
+_PDF_IMG_EXT_RE = re.compile(
+    rf'(?:{"|".join(map(re.escape, _PDF_IMG_EXTS))})(?=[?#]|$)',
+    re.IGNORECASE,
+)
+
+# Gamma 文档 URL 中的文档 ID（https://gamma.app/docs/<id>）
+_DOC_ID_RE = re.compile(r'/docs/([^/?]+)')
+
+# WordprocessingML 元素标签（用于流式解析 word/document.xml）
+_W_NS = "{http://schemas.openxmlformats.org/wordprocessingml/2006/main}"
+_W_P = f"{_W_NS}p"
+_W_R = f"{_W_NS}r"
+_W_T = f"{_W_NS}t"
+_W_TAB = f"{_W_NS}tab"
+_W_BR = f"{_W_NS}br"
+_W_CR = f"{_W_NS}cr"
+# 标记兼容性（mc:AlternateContent）：Word 将文本框等内容在 mc:Choice 和 mc:Fallback（VML）中各存一份
+_MC_FALLBACK = "{http://schemas.openxmlformats.org/markup-compatibility/2006}Fallback"
+
+# 通过 API 下载导出文件时的写入块大小（1 MiB）
+DOWNLOAD_CHUNK_SIZE = 1 << 20
+
+# 并发探测导出端点时 HEAD 请求的超时时间（秒）
+EXPORT_PROBE_TIMEOUT = 10
+
+# 输入文本长度限制（Gamma API 限制约 100,000 tokens）
+MAX_INPUT_TOKENS = 100000
+# 无法统计 token 数时按 1 token ≈ 4 字符粗略估算的字符上限
+MAX_INPUT_CHARS = 400000
+# 输入文本中最多附加的图片链接数
+MAX_IMAGE_URLS = 20
+# 超长 PDF 文本只在开头和结尾各这么多字符中查找图片链接
+IMAGE_SCAN_EDGE_CHARS = 200000
+# 统计 token 数使用的编码（与 Gamma 实际使用的分词器不一定相同，但远比按字符估算准确）
+TOKEN_ENCODING_NAME = "cl100k_base"
+# 词表下载地址（与 tiktoken 内置地址相同）和下载超时（秒）；tiktoken 自带的下载没有超时
+TOKEN_ENCODING_URL = f"https://openaipublic.blob.core.windows.net/encodings/{TOKEN_ENCODING_NAME}.tiktoken"
+TOKEN_ENCODING_TIMEOUT = 30
+
+# 页数达到该值时使用多进程并行提取 PDF 文本（页数较少时进程启动开销得不偿失）
+PDF_PARALLEL_MIN_PAGES = 8
+# 每个子进程任务至少处理的连续页数（每个任务都要重新打开并解析一次文件）
+PDF_MIN_PAGES_PER_TASK = 4
+# pypdf 提取 PDF 文本的分档规则：(页数上限, 每个子进程任务最多处理的连续页数)
+# 页数按 CPU 数平均分段，再受该上限约束：页数很多时分成更多段，各进程负载更均衡。
+# pypdf 是纯 Python 实现，受 GIL 限制，多线程没有收益，因此只区分串行和多进程。
+_PDF_EXTRACT_TIERS = (
+    (PDF_PARALLEL_MIN_PAGES - 1, None),  # None 表示在当前进程中串行提取
+    (200, 25),
+    (float("inf"), 50),
+)
+
+# PDFium 不是线程安全的，批量并发处理时需串行调用
+_PDFIUM_LOCK = threading.Lock()
+
+# tiktoken 编码器（首次截断时加载；首次加载可能需要联网下载词表），批量处理时只加载一次
+_token_encoding = None
+_TOKEN_ENCODING_LOCK = threading.Lock()
+
+# ChromeDriver 路径（只解析一次）和空闲的 Chrome 实例，按 (下载目录, 是否无头) 分组复用
+_CHROMEDRIVER_PATH = None
+_IDLE_BROWSER_DRIVERS = {}
+_BROWSER_LOCK = threading.Lock()
+# 浏览器导出共用一个下载暂存目录，批量处理时逐个进行
+_BROWSER_EXPORT_LOCK = threading.Lock()
+# 批量处理被中断（Ctrl+C）时置位：轮询和等待下载的循环检查它并尽快返回
+_STOP_EVENT = threading.Event()
+
+# 内存中的生成记录及索引（由 get_records() 首次访问时建立）
+_records_cache = None
+_records_by_path = {}
+_records_by_hash = {}
+# 区分“字段不存在”和“字段值为 None”
+_MISSING = object()
+# 并发处理多个文件时保护记录缓存和记录文件的写入
+_RECORDS_LOCK = threading.RLock()
+# 增量日志的追加句柄（首次写入时打开，压缩日志和进程退出时关闭）
+_records_log_handle = None
+# 追加句柄上是否有尚未 fsync 的写入
+_records_log_dirty = False
+
+
+def _is_docx_image_url(url):
+    """判断 .docx 中的链接是否为图片链接：以图片扩展名结尾，或包含常见图片服务域名"""
+    url_lower = url.lower()
+    return url_lower.endswith(_IMG_EXTS) or any(domain in url_lower for domain in _IMG_DOMAINS)
+
+
+def _is_pdf_image_url(url):
+    """判断 PDF 中的链接是否为图片链接：以图片扩展名结尾，允许后跟 ?query 或 #fragment"""
+    # 扩展名之前至少要有一个主机名字符
+    return _PDF_IMG_EXT_RE.search(url, url.index("://") + 4) is not None
+
+
+def _find_image_urls(text, is_image_url, spans=None):
+    """
+    按首次出现顺序查找去重后的图片链接，找到 MAX_IMAGE_URLS 个后立即停止扫描
+    
+    用 _URL_RE 线性扫描出候选 URL，再由 is_image_url 逐个判断是否为图片链接。
+    参数 spans 为要查找的 [(start, end), ...] 区间，默认查找整个文本。
+    所有链接都包含 "://"：不含它的文本直接跳过正则扫描。
+    """
+    if "://" not in text:
+        return []
+    found = {}
+    for start, end in spans or [(0, len(text))]:
+        for match in _URL_RE.finditer(text, start, end):
+            url = match.group(0)
+            if not is_image_url(url):
+                continue
+            found[url] = None  # dict 保持插入顺序，重复链接不改变位置
+            if len(found) >= MAX_IMAGE_URLS:
+                return list(found)
+    return list(found)
+
+
+def _iter_docx_paragraphs(file_path):
+    """
+    流式读取 .docx 中 word/document.xml 的段落文本
+    
+    使用 lxml.iterparse 按文档顺序逐个处理 <w:p>（包括表格单元格中的段落），
+    处理完立即释放元素，不构建 python-docx 的段落/表格/单元格对象，
+    内存占用与文档大小无关。
+    mc:Fallback 中的段落是 mc:Choice 的重复副本，直接跳过。
+    """
+    fallback_depth = 0
+    with zipfile.ZipFile(file_path) as zf, zf.open("word/document.xml") as f:
+        for event, elem in etree.iterparse(f, events=("start", "end"), tag=(_W_P, _MC_FALLBACK)):
+            if elem.tag == _MC_FALLBACK:
+                if event == "start":
+                    fallback_depth += 1
+                else:
+                    fallback_depth -= 1
+                    # 丢弃整个备用副本，外层段落提取文本时也不会再包含它
+                    elem.clear()
+                continue
+            if event == "start" or fallback_depth:
+                continue
+            
+            parts = []
+            for node in elem.iter(_W_T, _W_TAB, _W_BR, _W_CR):
+                if node.tag == _W_T:
+                    parts.append(node.text or "")
+                elif node.getparent().tag == _W_R:
+                    # 只处理文本运行中的制表符/换行（忽略 w:pPr 中的制表位定义）
+                    parts.append("\t" if node.tag == _W_TAB else "\n")
+            yield "".join(parts)
+            
+            # 释放已处理的元素及其前面的兄弟节点
+            elem.clear()
+            while elem.getprevious() is not None:
+                del elem.getparent()[0]
+
+
+def _read_docx_text_parts_with_python_docx(file_path):
+    """使用 python-docx 对象模型读取段落和表格文本（流式解析失败时的备用方案）"""
+    doc = Document(file_path)
+    text_parts = []
+    
+    # 提取段落文本
+    for paragraph in doc.paragraphs:
+        if paragraph.text.strip():
+            text_parts.append(paragraph.text)
+    
+    # 提取表格中的文本
+    for table in doc.tables:
+        for row in table.rows:
+            for cell in row.cells:
+                if cell.text.strip():
+                    text_parts.append(cell.text)
+    
+    return text_parts
 
 
 def extract_text_from_docx(file_path):
@@ -52,104 +372,350 @@ def extract_text_from_docx(file_path):
     返回: (text_content, image_urls)
     """
     try:
-        doc = Document(file_path)
-        text_parts = []
-        image_urls = []
-        
-        # 提取段落文本
-        for paragraph in doc.paragraphs:
-            if paragraph.text.strip():
-                text_parts.append(paragraph.text)
-        
-        # 提取表格中的文本
-        for table in doc.tables:
-            for row in table.rows:
-                for cell in row.cells:
-                    if cell.text.strip():
-                        text_parts.append(cell.text)
-        
-        # 从所有文本中提取图片 URL（包括段落和表格）
-        import re
-        all_text = "\n".join(text_parts)
-        # 查找所有 http/https 链接
-        urls = re.findall(r'https?://[^\s<>"{}|\\^`\[\]]+', all_text)
-        for url in urls:
-            # 检查是否是图片 URL（通过扩展名或常见图片服务域名）
-            url_lower = url.lower()
-            is_image = (
-                any(url_lower.endswith(ext) for ext in ['.jpg', '.jpeg', '.png', '.gif', '.webp', '.svg', '.bmp']) or
-                any(domain in url_lower for domain in ['imgur.com', 'imgbb.com', 'cloudinary.com', 'unsplash.com', 'pexels.com'])
-            )
-            if is_image and url not in image_urls:
-                image_urls.append(url)
+        try:
+            text_parts = [text for text in _iter_docx_paragraphs(file_path) if text.strip()]
+        except Exception as e:
+            print(f"流式解析 .docx 失败，改用 python-docx 读取: {e}")
+            text_parts = _read_docx_text_parts_with_python_docx(file_path)
         
+        # 从所有文本中提取图片 URL（包括段落和表格），按出现顺序去重
         text_content = "\n".join(text_parts)
+        image_urls = _find_image_urls(text_content, _is_docx_image_url)
         return text_content, image_urls
     except Exception as e:
         print(f"读取 .docx 文件时出错: {e}")
         return None, []
 
 
-def load_records():
-    """加载生成记录"""
+def _dumps_json(obj, indent=False):
+    """将对象序列化为 UTF-8 编码的 JSON 字节串（优先使用 orjson）"""
+    if ORJSON_AVAILABLE:
+        return orjson.dumps(obj, option=orjson.OPT_INDENT_2 if indent else 0)
+    return json.dumps(obj, ensure_ascii=False, indent=2 if indent else None).encode('utf-8')
+
+
+def _loads_json(data):
+    """解析 JSON 字节串（优先使用 orjson）"""
+    if ORJSON_AVAILABLE:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def _load_records_snapshot():
+    """
+    读取记录快照
+    
+    优先读取二进制快照；如果 JSON 快照比二进制快照更新
+    （例如被手动编辑过，或由未安装 msgpack/zstandard 的环境写入），则读取 JSON 快照。
+    """
+    if BINARY_RECORDS_AVAILABLE and RECORDS_BINARY_FILE.exists():
+        json_mtime = RECORDS_FILE.stat().st_mtime_ns if RECORDS_FILE.exists() else 0
+        if RECORDS_BINARY_FILE.stat().st_mtime_ns >= json_mtime:
+            try:
+                data = zstandard.ZstdDecompressor().decompress(RECORDS_BINARY_FILE.read_bytes())
+                return msgpack.unpackb(data)
+            except Exception as e:
+                print(f"加载二进制记录快照失败，改用 JSON 记录文件: {e}")
+    
     if RECORDS_FILE.exists():
         try:
-            with open(RECORDS_FILE, 'r', encoding='utf-8') as f:
-                return json.load(f)
+            return _loads_json(RECORDS_FILE.read_bytes())
         except Exception as e:
             print(f"加载记录文件失败: {e}")
-            return {}
     return {}
 
 
+def load_records():
+    """加载生成记录（读取记录快照，再按顺序重放增量日志）"""
+    records = _load_records_snapshot()
+    
+    if RECORDS_LOG_FILE.exists():
+        try:
+            with open(RECORDS_LOG_FILE, 'rb') as f:
+                for line in f:
+                    if not line.strip():
+                        continue
+                    try:
+                        entry = _loads_json(line)
+                        generation_id, patch = entry["id"], entry["patch"]
+                        if not isinstance(patch, dict):
+                            continue
+                        records.setdefault(generation_id, {}).update(patch)
+                    except (ValueError, KeyError, TypeError, AttributeError):
+                        # 未完整写入或格式不对的行（例如进程被中断）直接跳过，继续重放后面的行
+                        continue
+        except Exception as e:
+            print(f"读取记录日志失败: {e}")
+    
+    return records
+
+
+def _write_file_atomic(path, data):
+    """
+    原子地写入文件：先写入同目录下的临时文件并 fsync，再用 os.replace 替换目标文件
+    
+    任何时刻断电，目标文件要么是旧内容，要么是完整的新内容，不会出现空文件或写了一半的文件。
+    """
+    tmp_path = path.with_name(path.name + ".tmp")
+    with open(tmp_path, 'wb') as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+    # 同步目录项，确保替换本身也已落盘（Windows 不支持打开目录，跳过）
+    if hasattr(os, 'O_DIRECTORY'):
+        dir_fd = os.open(path.parent, os.O_RDONLY | os.O_DIRECTORY)
+        try:
+            os.fsync(dir_fd)
+        finally:
+            os.close(dir_fd)
+
+
 def save_records(records):
-    """保存生成记录"""
+    """保存生成记录（JSON 记录文件，以及可用时的二进制快照），每个文件都原子写入"""
     try:
-        with open(RECORDS_FILE, 'w', encoding='utf-8') as f:
-            json.dump(records, f, ensure_ascii=False, indent=2)
-        return True
+        _write_file_atomic(RECORDS_FILE, _dumps_json(records, indent=True))
     except Exception as e:
         print(f"保存记录文件失败: {e}")
         return False
+    
+    # 二进制快照在 JSON 之后写入，保证其修改时间不早于 JSON 记录文件
+    if BINARY_RECORDS_AVAILABLE:
+        try:
+            data = zstandard.ZstdCompressor(level=3).compress(msgpack.packb(records))
+            _write_file_atomic(RECORDS_BINARY_FILE, data)
+        except Exception as e:
+            print(f"保存二进制记录快照失败: {e}")
+            return False
+    return True
+
+
+def sync_records_log():
+    """
+    将增量日志中尚未落盘的修改 fsync 到磁盘
+    
+    追加记录时不逐条 fsync：同一次运行中的多条修改在关闭日志时合并为一次 fsync。
+    """
+    global _records_log_dirty
+    with _RECORDS_LOCK:
+        if _records_log_handle is not None and _records_log_dirty:
+            try:
+                os.fsync(_records_log_handle.fileno())
+                _records_log_dirty = False
+            except OSError as e:
+                print(f"同步记录日志失败: {e}")
+
+
+@atexit.register
+def _close_records_log():
+    """同步并关闭增量日志的追加句柄"""
+    global _records_log_handle, _records_log_dirty
+    with _RECORDS_LOCK:
+        if _records_log_handle is not None:
+            sync_records_log()
+            _records_log_handle.close()
+            _records_log_handle = None
+            _records_log_dirty = False
 
 
-def get_file_hash(file_path):
-    """计算文件的哈希值，用于唯一标识文件"""
+@atexit.register
+def _compact_records_on_exit():
+    """
+    进程退出时把增量日志合并回快照文件，使 RECORDS_FILE 始终包含全部记录
+    
+    （在 _close_records_log 之后注册，atexit 按注册的相反顺序执行，因此先于它运行）
+    """
     try:
-        hash_md5 = hashlib.md5()
-        with open(file_path, 'rb') as f:
-            for chunk in iter(lambda: f.read(4096), b""):
-                hash_md5.update(chunk)
-        return hash_md5.hexdigest()
+        if RECORDS_LOG_FILE.exists() and RECORDS_LOG_FILE.stat().st_size > 0:
+            compact_records()
+    except Exception as e:
+        print(f"合并记录日志失败: {e}")
+
+
+def compact_records():
+    """将内存中的全部记录写回快照文件，并清空增量日志"""
+    global _records_log_dirty
+    with _RECORDS_LOCK:
+        # 快照已 fsync 并原子替换后才清空日志：断电时至少有一份完整的记录
+        if not save_records(get_records()):
+            return False
+        # 日志内容已持久化到快照，即将清空，无需再 fsync
+        _records_log_dirty = False
+        _close_records_log()
+        try:
+            RECORDS_LOG_FILE.write_bytes(b"")
+            return True
+        except Exception as e:
+            print(f"清空记录日志失败: {e}")
+            return False
+
+
+def _open_records_log():
+    """
+    打开增量日志的追加句柄（不做缓冲）
+    
+    上次运行中途被中断时，日志末尾可能是一行未写完的内容：先补一个换行，
+    之后追加的记录另起一行，不会与它连成一行而在重放时被一起丢弃。
+    """
+    handle = open(RECORDS_LOG_FILE, 'ab', buffering=0)
+    try:
+        if handle.tell() > 0:
+            with open(RECORDS_LOG_FILE, 'rb') as f:
+                f.seek(-1, os.SEEK_END)
+                if f.read(1) != b"\n":
+                    handle.write(b"\n")
+    except Exception:
+        handle.close()
+        raise
+    return handle
+
+
+def _append_record_log(generation_id, patch):
+    """
+    向增量日志追加一条记录修改
+    
+    每次修改只追加一行，代价与记录总数无关；
+    日志句柄在多次修改间保持打开且不做缓冲，每条修改只需一次 write 系统调用；
+    fsync 由 sync_records_log() 批量完成。
+    日志增长到一定大小后自动压缩回快照文件。
+    """
+    global _records_log_handle, _records_log_dirty
+    with _RECORDS_LOCK:
+        try:
+            if _records_log_handle is None:
+                _records_log_handle = _open_records_log()
+            _records_log_handle.write(_dumps_json({"id": generation_id, "patch": patch}) + b"\n")
+            _records_log_dirty = True
+            # 追加模式下写入后的位置即为日志大小，无需再 stat
+            log_size = _records_log_handle.tell()
+        except Exception as e:
+            print(f"写入记录日志失败: {e}")
+            _close_records_log()
+            return False
+        
+        snapshot_size = RECORDS_FILE.stat().st_size if RECORDS_FILE.exists() else 0
+        if log_size > max(RECORDS_COMPACT_MIN_SIZE, RECORDS_COMPACT_RATIO * snapshot_size):
+            compact_records()
+        return True
+
+
+def _index_record(record):
+    """将单条记录加入文件路径 / 哈希值索引（同一文件以最新记录为准）"""
+    if record.get('file_path'):
+        _records_by_path[record['file_path']] = record
+    if record.get('file_hash'):
+        _records_by_hash[record['file_hash']] = record
+
+
+def get_records():
+    """
+    获取内存中的生成记录
+    
+    首次调用时从记录文件加载，并建立按文件路径和哈希值的索引，
+    之后的查询和修改都直接作用于这份内存数据。
+    """
+    global _records_cache
+    with _RECORDS_LOCK:
+        if _records_cache is None:
+            _records_cache = load_records()
+            _records_by_path.clear()
+            _records_by_hash.clear()
+            for record in _records_cache.values():
+                _index_record(record)
+        return _records_cache
+
+
+def _resolve_file(file_path, resolved=None, st=None):
+    """返回 (绝对路径, stat 结果)，调用方已经得到的值直接复用，不再重复系统调用"""
+    if resolved is None:
+        resolved = Path(file_path).resolve()
+    if st is None:
+        st = resolved.stat()
+    return resolved, st
+
+
+def get_file_hash(file_path, resolved=None, st=None):
+    """
+    计算文件的哈希值，用于唯一标识文件
+    
+    仍使用 MD5，以便与已有记录中的 file_hash 保持兼容。
+    Python 3.11+ 使用 hashlib.file_digest（C 层读取循环），
+    否则退回到 1 MiB 分块读取以减少系统调用次数。
+    结果按 (路径, mtime, size) 缓存，同一文件重复调用时不会再次读取。
+    
+    参数:
+    - file_path: 文件路径
+    - resolved / st: 调用方已解析好的绝对路径和 stat 结果（可选）
+    """
+    try:
+        resolved, st = _resolve_file(file_path, resolved, st)
+        cache_key = (str(resolved), st.st_mtime_ns, st.st_size)
+        cached = _HASH_CACHE.get(cache_key)
+        if cached:
+            return cached
+        
+        with open(resolved, 'rb') as f:
+            if hasattr(hashlib, "file_digest"):
+                file_hash = hashlib.file_digest(f, "md5").hexdigest()
+            else:
+                hash_md5 = hashlib.md5()
+                for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b""):
+                    hash_md5.update(chunk)
+                file_hash = hash_md5.hexdigest()
+        
+        _HASH_CACHE[cache_key] = file_hash
+        return file_hash
     except Exception as e:
         print(f"计算文件哈希失败: {e}")
         return None
 
 
-def check_existing_generation(file_path):
+def check_existing_generation(file_path, file_hash=None, resolved=None, st=None):
     """
     检查文件是否已经生成过
     
+    先按文件路径查找：如果记录中的文件大小和修改时间与当前文件一致，
+    直接返回该记录，无需读取文件计算哈希；否则按文件哈希值查找。
+    
+    参数:
+    - file_path: 输入文件路径
+    - file_hash: 预先计算好的文件哈希（可选，需要时自动计算）
+    - resolved / st: 调用方已解析好的绝对路径和 stat 结果（可选）
+    
     返回: (exists, record) 如果存在则返回记录，否则返回 None
     """
-    file_hash = get_file_hash(file_path)
-    if not file_hash:
+    get_records()
+    
+    try:
+        resolved, st = _resolve_file(file_path, resolved, st)
+    except OSError as e:
+        print(f"读取文件信息失败: {e}")
         return False, None
+    file_path_str = str(resolved)
     
-    records = load_records()
+    record = _records_by_path.get(file_path_str)
+    if (record and record.get('file_size') == st.st_size
+            and record.get('file_mtime_ns') == st.st_mtime_ns):
+        return True, record
     
-    # 检查文件路径和哈希值
-    file_path_str = str(Path(file_path).resolve())
+    if file_hash is None:
+        file_hash = get_file_hash(resolved, resolved=resolved, st=st)
+    if not file_hash:
+        return False, None
     
-    for record_id, record in records.items():
-        if (record.get('file_path') == file_path_str or 
-            record.get('file_hash') == file_hash):
-            return True, record
+    record = _records_by_hash.get(file_hash)
+    if record:
+        # 补充/刷新记录中的文件大小和修改时间，下次可直接按路径命中
+        if record.get('file_path') == file_path_str and record.get('generation_id'):
+            update_generation_record(record['generation_id'],
+                                     file_size=st.st_size, file_mtime_ns=st.st_mtime_ns)
+        return True, record
     
     return False, None
 
 
-def add_generation_record(file_path, generation_id, gamma_url, status="completed"):
+def add_generation_record(file_path, generation_id, gamma_url, status="completed", file_hash=None,
+                          resolved=None, st=None):
     """
     添加生成记录
     
@@ -158,44 +724,69 @@ def add_generation_record(file_path, generation_id, gamma_url, status="completed
     - generation_id: 生成任务 ID
     - gamma_url: Gamma 演示文稿 URL
     - status: 生成状态
+    - file_hash: 预先计算好的文件哈希（可选，未提供时自动计算）
+    - resolved / st: 调用方已解析好的绝对路径和 stat 结果（可选）
     """
-    file_hash = get_file_hash(file_path)
+    try:
+        resolved, st = _resolve_file(file_path, resolved, st)
+    except OSError as e:
+        print(f"读取文件信息失败: {e}")
+        return False
+    if file_hash is None:
+        file_hash = get_file_hash(resolved, resolved=resolved, st=st)
     if not file_hash:
         return False
     
-    records = load_records()
+    now_iso = datetime.now().isoformat()
     
     # 使用 generation_id 作为记录 ID
     record = {
-        "file_path": str(Path(file_path).resolve()),
+        "file_path": str(resolved),
         "file_name": Path(file_path).name,
         "file_hash": file_hash,
+        "file_size": st.st_size,
+        "file_mtime_ns": st.st_mtime_ns,
         "generation_id": generation_id,
         "gamma_url": gamma_url,
         "status": status,
-        "created_at": datetime.now().isoformat(),
-        "updated_at": datetime.now().isoformat()
+        "created_at": now_iso,
+        "updated_at": now_iso
     }
     
-    records[generation_id] = record
-    return save_records(records)
+    with _RECORDS_LOCK:
+        records = get_records()
+        records[generation_id] = record
+        _index_record(record)
+        return _append_record_log(generation_id, record)
 
 
 def update_generation_record(generation_id, **kwargs):
-    """更新生成记录"""
-    records = load_records()
-    
-    if generation_id in records:
-        records[generation_id].update(kwargs)
-        records[generation_id]["updated_at"] = datetime.now().isoformat()
-        return save_records(records)
+    """
+    更新生成记录
     
-    return False
+    只有字段值真正发生变化时才更新 updated_at 并写入日志，
+    重复写入相同的状态不会产生任何磁盘操作。
+    """
+    with _RECORDS_LOCK:
+        records = get_records()
+        
+        if generation_id in records:
+            record = records[generation_id]
+            changes = {key: value for key, value in kwargs.items() if record.get(key, _MISSING) != value}
+            if not changes:
+                return True
+            
+            changes["updated_at"] = datetime.now().isoformat()
+            record.update(changes)
+            _index_record(record)
+            return _append_record_log(generation_id, changes)
+        
+        return False
 
 
 def list_generations():
     """列出所有生成记录"""
-    records = load_records()
+    records = get_records()
     
     if not records:
         print("没有找到生成记录")
@@ -219,16 +810,116 @@ def list_generations():
     print("\n" + "=" * 80)
 
 
+@contextmanager
+def _open_pdf_reader(file_path):
+    """
+    打开 PDF 文件并返回 PdfReader，文件内容通过 mmap 只读映射
+    
+    pypdf 解析时会频繁 seek/read，映射后直接从页缓存读取，不必每次都进行系统调用。
+    空文件无法映射，此时退回普通文件对象（由 pypdf 报告解析错误）。
+    """
+    with open(file_path, 'rb') as file:
+        try:
+            mapped = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        except (ValueError, OSError):
+            yield PdfReader(file)
+            return
+        with mapped:
+            yield PdfReader(mapped)
+
+
+def _extract_pdf_pages_text(task):
+    """
+    子进程任务：提取 PDF 中一段连续页的文本
+    
+    参数 task 为 (file_path, start, stop)，每个子进程自行打开文件并只解析一次，
+    各页的内容流相互独立，可以并行解析。
+    """
+    file_path, start, stop = task
+    with _open_pdf_reader(file_path) as pdf_reader:
+        pages = pdf_reader.pages
+        return [pages[i].extract_text() or "" for i in range(start, stop)]
+
+
+def _pdf_page_batch_size(num_pages):
+    """
+    按分档规则返回每个子进程任务的页数，返回 None 表示应串行提取
+    
+    页数按 CPU 数平均分段（不少于 PDF_MIN_PAGES_PER_TASK 页，不超过所在档位的上限）；
+    分不出至少两个任务时并行没有收益，也返回 None。
+    """
+    cpu_count = os.cpu_count() or 1
+    if cpu_count < 2:
+        return None
+    for max_pages, max_batch_size in _PDF_EXTRACT_TIERS:
+        if num_pages <= max_pages:
+            break
+    else:
+        return None
+    if max_batch_size is None:
+        return None
+    batch_size = min(max_batch_size, max(PDF_MIN_PAGES_PER_TASK, -(-num_pages // cpu_count)))
+    if -(-num_pages // batch_size) < 2:
+        return None
+    return batch_size
+
+
+def _extract_pdf_text_with_pdfium(file_path):
+    """
+    使用 PDFium 逐页提取 PDF 文本，返回各页文本列表
+    """
+    with _PDFIUM_LOCK:
+        pdf = pypdfium2.PdfDocument(str(file_path))
+        try:
+            texts = []
+            for page in pdf:
+                textpage = page.get_textpage()
+                # PDFium 使用 \r\n 换行，统一为 \n 与 pypdf 的输出保持一致
+                texts.append(textpage.get_text_range().replace("\r\n", "\n"))
+                textpage.close()
+                page.close()
+            return texts
+        finally:
+            pdf.close()
+
+
 def extract_text_from_pdf(file_path):
-    """从 PDF 文件中提取文本内容"""
+    """
+    从 PDF 文件中提取文本内容
+    
+    安装了 pypdfium2 时优先使用原生 PDFium 提取；否则使用 pypdf，
+    按 _PDF_EXTRACT_TIERS 决定串行提取，或将连续页分段分发到多个进程并行提取，
+    结果按页码顺序拼接。
+    """
+    if PDFIUM_AVAILABLE:
+        try:
+            texts = _extract_pdf_text_with_pdfium(file_path)
+            return "\n".join(text for text in texts if text.strip())
+        except Exception as e:
+            print(f"PDFium 提取 PDF 文本失败，改用 pypdf: {e}")
+    
     try:
-        text_parts = []
-        with open(file_path, 'rb') as file:
-            pdf_reader = PyPDF2.PdfReader(file)
-            for page in pdf_reader.pages:
-                text = page.extract_text()
-                if text.strip():
-                    text_parts.append(text)
+        with _open_pdf_reader(file_path) as pdf_reader:
+            num_pages = len(pdf_reader.pages)
+            
+            texts = None
+            batch_size = _pdf_page_batch_size(num_pages)
+            if batch_size:
+                tasks = [
+                    (str(file_path), start, min(start + batch_size, num_pages))
+                    for start in range(0, num_pages, batch_size)
+                ]
+                try:
+                    with ProcessPoolExecutor(max_workers=min(len(tasks), os.cpu_count())) as executor:
+                        # map 按提交顺序返回结果，拼接后即为页码顺序
+                        texts = [text for batch in executor.map(_extract_pdf_pages_text, tasks) for text in batch]
+                except Exception as e:
+                    print(f"并行提取 PDF 文本失败，改为逐页提取: {e}")
+            
+            if texts is None:
+                texts = [page.extract_text() or "" for page in pdf_reader.pages]
+        
+        text_parts = [text for text in texts if text.strip()]
         return "\n".join(text_parts)
     except Exception as e:
         print(f"读取 PDF 文件时出错: {e}")
@@ -249,18 +940,14 @@ def generate_presentation(input_text, theme_id=None, num_cards=None, additional_
         raise ValueError("请设置 GAMMA_API_KEY 环境变量")
     
     url = f"{GAMMA_API_BASE_URL}/generations"
-    headers = {
-        "X-API-KEY": GAMMA_API_KEY,
-        "Content-Type": "application/json"
-    }
     
-    # 构建请求参数（必需参数）
+    # 构建请求参数：固定部分来自模板，只合并本次请求的动态字段
     payload = {
+        **_PAYLOAD_TEMPLATE,
         "inputText": input_text,
-        "textMode": "generate",
-        "format": "presentation",
-        "cardSplit": "auto",
-        "exportAs": "pdf"
+        # 如果提供了图片 URL，使用 noImages 以仅使用提供的图片（根据官方文档）
+        # 否则使用 aiGenerated 让 Gamma 生成图片
+        "imageOptions": _IMAGE_OPTIONS_NO_IMAGES if has_image_urls else _IMAGE_OPTIONS_AI_GENERATED,
     }
     
     # 可选参数：themeId（根据官方文档，如果不提供则使用工作区默认主题）
@@ -274,49 +961,9 @@ def generate_presentation(input_text, theme_id=None, num_cards=None, additional_
     if additional_instructions:
         payload["additionalInstructions"] = additional_instructions
     
-    # 文本选项（根据官方文档：https://developers.gamma.app/docs/generate-api-parameters-explained）
-    payload["textOptions"] = {
-        "amount": "detailed",  # 可选: "brief", "medium", "detailed"
-        "tone": "professional",  # 可选: 一个或多个词，1-500字符
-        "audience": "general",  # 可选: 一个或多个词，1-500字符，描述目标受众
-        "language": "en"  # 可选: 默认 "en"，支持多种语言
-    }
-    
-    # 图像选项（根据官方文档）
-    # 如果提供了图片 URL，使用 noImages 以仅使用提供的图片（根据官方文档）
-    # 否则使用 aiGenerated 让 Gamma 生成图片
-    image_source = "noImages" if has_image_urls else "aiGenerated"
-    
-    payload["imageOptions"] = {
-        "source": image_source,  # 可选: "aiGenerated"(默认), "pictographic", "unsplash", "giphy", "webAllImages", "webFreeToUse", "webFreeToUseCommercially", "placeholder", "noImages"
-    }
-    
-    # 仅在 source 为 "aiGenerated" 时添加 model 和 style
-    if image_source == "aiGenerated":
-        payload["imageOptions"]["model"] = "imagen-4-pro"  # 可选: 仅在 source 为 "aiGenerated" 时相关
-        payload["imageOptions"]["style"] = "photorealistic"  # 可选: 仅在 source 为 "aiGenerated" 时相关
-    
-    # 卡片选项（根据官方文档）
-    # cardOptions 支持 dimensions 和 headerFooter，不支持 size、includeHeader、includeFooter
-    payload["cardOptions"] = {
-        "dimensions": "fluid"  # 可选: "fluid"(默认), "16x9", "4x3" (format 为 presentation 时)
-        # headerFooter 是可选的，如果需要可以添加，例如：
-        # "headerFooter": {
-        #     "topRight": {
-        #         "type": "image",
-        #         "source": "themeLogo",
-        #         "size": "sm"
-        #     },
-        #     "bottomRight": {
-        #         "type": "cardNumber"
-        #     },
-        #     "hideFromFirstCard": true,
-        #     "hideFromLastCard": false
-        # }
-    }
-    
     print("正在调用 Gamma API 生成演示文稿...")
-    response = requests.post(url, json=payload, headers=headers)
+    # 预先序列化请求体（可用时使用 orjson，比 requests 内置的 json 序列化更快）
+    response = _SESSION.post(url, data=_dumps_json(payload), headers={"Content-Type": "application/json"})
     
     # 201 (Created) 和 200 (OK) 都表示成功
     if response.status_code not in [200, 201]:
@@ -324,7 +971,8 @@ def generate_presentation(input_text, theme_id=None, num_cards=None, additional_
         print(f"错误信息: {response.text}")
         return None
     
-    result = response.json()
+    # 直接解析响应字节（可用时使用 orjson），无需先解码为字符串
+    result = _loads_json(response.content)
     generation_id = result.get("generationId")
     
     if not generation_id:
@@ -346,37 +994,43 @@ def check_generation_status(generation_id):
         raise ValueError("请设置 GAMMA_API_KEY 环境变量")
     
     url = f"{GAMMA_API_BASE_URL}/generations/{generation_id}"
-    headers = {
-        "X-API-KEY": GAMMA_API_KEY,
-        "Content-Type": "application/json"
-    }
     
-    response = requests.get(url, headers=headers)
+    response = _SESSION.get(url)
     
     if response.status_code != 200:
         print(f"查询状态失败: {response.status_code}")
         print(f"错误信息: {response.text}")
         return None, None
     
-    result = response.json()
+    result = _loads_json(response.content)
     status = result.get("status", "unknown")
     return status, result
 
 
-def wait_for_completion(generation_id, max_wait_time=300, check_interval=5):
+def wait_for_completion(generation_id, max_wait_time=300, check_interval=1, max_check_interval=30):
     """
     等待生成完成
     
+    轮询间隔从 check_interval 开始按指数增长（不超过 max_check_interval），
+    并加入少量随机抖动：很快完成的任务能及时发现，耗时较长的任务也不会频繁请求 API。
+    状态从 pending 变为 processing 时间隔重新从头开始。
+    
     参数:
     - generation_id: 生成任务 ID
     - max_wait_time: 最大等待时间（秒）
-    - check_interval: 检查间隔（秒）
+    - check_interval: 初始检查间隔（秒）
+    - max_check_interval: 最大检查间隔（秒）
     
     返回: (success, result_data)
     """
     start_time = time.time()
+    attempts = 0
+    last_status = None
     
     while time.time() - start_time < max_wait_time:
+        if _STOP_EVENT.is_set():
+            print("已中断：停止等待生成结果")
+            return False, None
         status, result = check_generation_status(generation_id)
         
         if status is None:
@@ -391,16 +1045,93 @@ def wait_for_completion(generation_id, max_wait_time=300, check_interval=5):
             print("生成失败！")
             return False, result
         elif status in ["pending", "processing"]:
+            if last_status == "pending" and status == "processing":
+                attempts = 0
             print(f"等待中... ({int(time.time() - start_time)}秒)")
-            time.sleep(check_interval)
         else:
             print(f"未知状态: {status}")
-            time.sleep(check_interval)
+        last_status = status
+        
+        # 指数退避 + 随机抖动，且不超过剩余等待时间
+        delay = min(max_check_interval, check_interval * (POLL_BACKOFF_FACTOR ** attempts))
+        delay += random.uniform(0, POLL_JITTER)
+        remaining = max_wait_time - (time.time() - start_time)
+        _STOP_EVENT.wait(max(0, min(delay, remaining)))
+        attempts += 1
     
     print(f"超时：等待时间超过 {max_wait_time} 秒")
     return False, None
 
 
+def _warm_connection(url):
+    """
+    在后台线程中向 url 所在主机发送一个 HEAD 请求，提前完成 DNS 解析和 TCP/TLS 握手
+    
+    连接随后留在 _SESSION 的连接池中，之后对同一主机的请求可直接复用；
+    预热失败不影响后续流程。返回后台线程。
+    预热只需要建立连接，请求中去掉会话默认携带的 X-API-KEY，不把密钥发给非 API 页面。
+    """
+    def warm():
+        try:
+            # 请求头值为 None 时 requests 会移除会话中的同名请求头
+            _SESSION.head(url, headers={"X-API-KEY": None}, timeout=EXPORT_PROBE_TIMEOUT).close()
+        except requests.RequestException:
+            pass
+    
+    thread = threading.Thread(target=warm, daemon=True)
+    thread.start()
+    return thread
+
+
+def _probe_export_urls(export_urls, headers):
+    """
+    并发探测候选导出端点，返回按优先级排序、值得继续下载的端点列表
+    
+    对所有候选端点同时发送短超时的 HEAD 请求，总耗时取决于最快返回 200 的端点，
+    而不是逐个请求的耗时之和：
+    - 第一个返回 200 的端点排在最前面，其余探测不再等待
+    - 其他端点保留原顺序排在后面，仍用 GET 尝试（部分端点对 HEAD 和 GET 的响应不同）
+    - 只有明确不存在（404/410）的端点直接跳过
+    每个未返回 200 的探测结果都会打印出来，便于排查导出失败的原因。
+    """
+    if len(export_urls) <= 1:
+        return list(export_urls)
+    
+    print(f"并发探测 {len(export_urls)} 个 API 端点...")
+    failed_urls = set()
+    winner = None
+    executor = ThreadPoolExecutor(max_workers=len(export_urls))
+    futures = {
+        executor.submit(_SESSION.head, export_url, headers=headers,
+                        timeout=EXPORT_PROBE_TIMEOUT, allow_redirects=True): export_url
+        for export_url in export_urls
+    }
+    try:
+        for future in as_completed(futures):
+            export_url = futures[future]
+            try:
+                response = future.result()
+            except Exception as e:
+                print(f"探测端点出错，稍后用 GET 重试: {export_url} ({e})")
+                continue
+            status_code = response.status_code
+            response.close()
+            if status_code == 200:
+                winner = export_url
+                break
+            elif status_code in (404, 410):
+                print(f"探测端点不存在 (状态码 {status_code})，跳过: {export_url}")
+                failed_urls.add(export_url)
+            else:
+                print(f"探测端点返回状态码 {status_code}，稍后用 GET 重试: {export_url}")
+    finally:
+        # 已找到可用端点时不再等待其余探测请求
+        executor.shutdown(wait=False, cancel_futures=True)
+    
+    candidates = [url for url in export_urls if url != winner and url not in failed_urls]
+    return ([winner] if winner else []) + candidates
+
+
 def download_via_api(gamma_url, generation_id, output_path, export_format="pdf"):
     """
     尝试通过 API 下载导出的文件
@@ -414,15 +1145,13 @@ def download_via_api(gamma_url, generation_id, output_path, export_format="pdf")
     返回: (success, method_used)
     """
     headers = {
-        "X-API-KEY": GAMMA_API_KEY,
         "Accept": f"application/{export_format}" if export_format == "pdf" else "application/vnd.openxmlformats-officedocument.presentationml.presentation"
     }
     
-    import re
     doc_id = None
     
     # 从 URL 中提取文档 ID
-    doc_id_match = re.search(r'/docs/([^/?]+)', gamma_url)
+    doc_id_match = _DOC_ID_RE.search(gamma_url)
     if doc_id_match:
         doc_id = doc_id_match.group(1)
     
@@ -431,54 +1160,81 @@ def download_via_api(gamma_url, generation_id, output_path, export_format="pdf")
         export_urls = [
             f"{GAMMA_API_BASE_URL}/docs/{doc_id}/export/{export_format}",
             f"{GAMMA_API_BASE_URL}/generations/{generation_id}/export/{export_format}",
-            f"https://gamma.app/api/export/{export_format}/{doc_id}",
+            f"{GAMMA_APP_BASE_URL}/api/export/{export_format}/{doc_id}",
         ]
     else:
         export_urls = [
             f"{GAMMA_API_BASE_URL}/generations/{generation_id}/export/{export_format}",
         ]
     
-    for export_url in export_urls:
+    for export_url in _probe_export_urls(export_urls, headers):
         try:
             print(f"尝试 API 端点: {export_url}")
-            response = requests.get(export_url, headers=headers, stream=True, timeout=60)
-            
-            if response.status_code == 200:
-                # 检查内容类型或文件头
-                content_type = response.headers.get('Content-Type', '')
-                
-                # 检查是否是目标格式
-                is_valid = False
-                if export_format == "pdf":
-                    is_valid = (
-                        'pdf' in content_type.lower() or 
-                        response.content[:4] == b'%PDF'
-                    )
-                elif export_format == "pptx":
-                    is_valid = (
-                        'presentation' in content_type.lower() or
-                        'pptx' in content_type.lower() or
-                        response.content[:2] == b'PK'  # PPTX 是 ZIP 格式
-                    )
-                
-                if is_valid:
-                    with open(output_path, 'wb') as f:
-                        for chunk in response.iter_content(chunk_size=8192):
-                            if chunk:
-                                f.write(chunk)
-                    print(f"{export_format.upper()} 已通过 API 保存到: {output_path}")
-                    return True, "api"
+            with _SESSION.get(export_url, headers=headers, stream=True, timeout=60) as response:
+                if response.status_code == 200:
+                    # 检查内容类型或文件头
+                    content_type = response.headers.get('Content-Type', '')
+                    
+                    # 只读取开头几个字节判断格式，不把整个响应缓存在内存中
+                    response.raw.decode_content = True
+                    head = response.raw.read(4)
+                    
+                    # 检查是否是目标格式
+                    is_valid = False
+                    if export_format == "pdf":
+                        is_valid = (
+                            'pdf' in content_type.lower() or 
+                            head[:4] == b'%PDF'
+                        )
+                    elif export_format == "pptx":
+                        is_valid = (
+                            'presentation' in content_type.lower() or
+                            'pptx' in content_type.lower() or
+                            head[:2] == b'PK'  # PPTX 是 ZIP 格式
+                        )
+                    
+                    if is_valid:
+                        # 未压缩传输时 Content-Length 即为文件大小：预先分配磁盘空间，写完后校验长度
+                        expected_size = None
+                        if not response.headers.get('Content-Encoding'):
+                            try:
+                                expected_size = int(response.headers.get('Content-Length', ''))
+                            except ValueError:
+                                pass
+                        
+                        # 写入已读取的文件头，其余内容按 1 MiB 分块直接流式写入磁盘；
+                        # 传输中断时删除不完整的文件
+                        try:
+                            with open(output_path, 'wb') as f:
+                                if expected_size and hasattr(os, 'posix_fallocate'):
+                                    try:
+                                        os.posix_fallocate(f.fileno(), 0, expected_size)
+                                    except OSError:
+                                        pass
+                                f.write(head)
+                                shutil.copyfileobj(response.raw, f, DOWNLOAD_CHUNK_SIZE)
+                                written = f.tell()
+                        except Exception:
+                            output_path.unlink(missing_ok=True)
+                            raise
+                        
+                        if expected_size is not None and written != expected_size:
+                            print(f"下载不完整（{written}/{expected_size} 字节），已删除: {output_path}")
+                            output_path.unlink(missing_ok=True)
+                            continue
+                        print(f"{export_format.upper()} 已通过 API 保存到: {output_path}")
+                        return True, "api"
+                    else:
+                        print(f"响应不是 {export_format.upper()} 格式，Content-Type: {content_type}")
+                        continue
+                elif response.status_code == 202:
+                    print(f"导出请求已接受，但需要等待处理 (状态码 202)")
+                    continue
                 else:
-                    print(f"响应不是 {export_format.upper()} 格式，Content-Type: {content_type}")
+                    print(f"API 请求失败 (状态码 {response.status_code})")
+                    if response.text:
+                        print(f"错误信息: {response.text[:200]}")
                     continue
-            elif response.status_code == 202:
-                print(f"导出请求已接受，但需要等待处理 (状态码 202)")
-                continue
-            else:
-                print(f"API 请求失败 (状态码 {response.status_code})")
-                if response.text:
-                    print(f"错误信息: {response.text[:200]}")
-                continue
         except Exception as e:
             print(f"API 请求异常: {e}")
             continue
@@ -486,6 +1242,166 @@ def download_via_api(gamma_url, generation_id, output_path, export_format="pdf")
     return False, None
 
 
+def _ensure_selenium():
+    """
+    按需导入 Selenium 相关模块
+    
+    返回: Selenium 是否可用
+    """
+    global SELENIUM_AVAILABLE, webdriver, By, WebDriverWait, EC, Service, Options, ChromeDriverManager
+    if SELENIUM_AVAILABLE is None:
+        try:
+            from selenium import webdriver
+            from selenium.webdriver.common.by import By
+            from selenium.webdriver.support.ui import WebDriverWait
+            from selenium.webdriver.support import expected_conditions as EC
+            from selenium.webdriver.chrome.service import Service
+            from selenium.webdriver.chrome.options import Options
+            from webdriver_manager.chrome import ChromeDriverManager
+            SELENIUM_AVAILABLE = True
+        except ImportError:
+            SELENIUM_AVAILABLE = False
+            print("警告: Selenium 未安装，浏览器自动化功能将不可用")
+            print("如需使用浏览器自动化导出，请运行: pip install selenium webdriver-manager")
+    return SELENIUM_AVAILABLE
+
+
+def _acquire_browser_driver(download_dir, headless):
+    """
+    获取一个 Chrome WebDriver
+    
+    优先复用之前下载成功后留下的空闲浏览器（避免每次 1-3 秒的 Chrome 冷启动），
+    否则启动新的浏览器；ChromeDriverManager().install() 在进程内只调用一次。
+    每个实例同一时间只交给一个调用方使用，用完通过 _release_browser_driver() 归还。
+    """
+    global _CHROMEDRIVER_PATH
+    key = (download_dir, headless)
+    
+    with _BROWSER_LOCK:
+        idle_drivers = _IDLE_BROWSER_DRIVERS.get(key, [])
+        while idle_drivers:
+            driver = idle_drivers.pop()
+            try:
+                driver.current_window_handle  # 检查浏览器是否仍然可用（可能已被用户关闭）
+                print("复用已打开的 Chrome 浏览器")
+                return driver
+            except Exception:
+                continue
+        if _CHROMEDRIVER_PATH is None:
+            _CHROMEDRIVER_PATH = ChromeDriverManager().install()
+    
+    # 配置 Chrome 选项
+    chrome_options = Options()
+    if headless:
+        chrome_options.add_argument('--headless=new')  # 使用新的 headless 模式
+    chrome_options.add_argument('--no-sandbox')
+    chrome_options.add_argument('--disable-dev-shm-usage')
+    chrome_options.add_argument('--disable-gpu')
+    chrome_options.add_argument('--window-size=1920,1080')
+    
+    prefs = {
+        "download.default_directory": download_dir,
+        "download.prompt_for_download": False,
+        "download.directory_upgrade": True,
+        "safebrowsing.enabled": False,  # 禁用安全浏览以加快下载
+        "profile.default_content_setting_values.notifications": 2  # 禁用通知
+    }
+    chrome_options.add_experimental_option("prefs", prefs)
+    chrome_options.add_experimental_option("excludeSwitches", ["enable-automation"])
+    chrome_options.add_experimental_option('useAutomationExtension', False)
+    
+    print("正在启动 Chrome 浏览器...")
+    return webdriver.Chrome(service=Service(_CHROMEDRIVER_PATH), options=chrome_options)
+
+
+def _release_browser_driver(driver, download_dir, headless):
+    """将浏览器放回空闲列表，供后续下载复用"""
+    with _BROWSER_LOCK:
+        _IDLE_BROWSER_DRIVERS.setdefault((download_dir, headless), []).append(driver)
+
+
+@atexit.register
+def _close_idle_browser_drivers():
+    """程序退出时关闭空闲的无头浏览器（有界面的浏览器保持打开，由用户手动关闭）"""
+    for (_, headless), drivers in _IDLE_BROWSER_DRIVERS.items():
+        if headless:
+            for driver in drivers:
+                try:
+                    driver.quit()
+                except Exception:
+                    pass
+
+
+def _start_download_watcher(directory, export_format, download_event):
+    """
+    监听下载目录，出现目标格式的文件（新建或由 .crdownload 重命名而来）时设置 download_event
+    
+    使用 watchdog（inotify / ReadDirectoryChangesW 等系统文件通知）代替定时扫描目录；
+    未安装 watchdog 或启动监听失败时返回 None，由调用方退回到轮询。
+    """
+    try:
+        from watchdog.observers import Observer
+        from watchdog.events import FileSystemEventHandler
+    except ImportError:
+        return None
+    
+    suffix = f".{export_format}".lower()
+    
+    class _DownloadHandler(FileSystemEventHandler):
+        def on_any_event(self, event):
+            path = getattr(event, "dest_path", "") or event.src_path
+            if not event.is_directory and str(path).lower().endswith(suffix):
+                download_event.set()
+    
+    try:
+        observer = Observer()
+        observer.schedule(_DownloadHandler(), str(directory), recursive=False)
+        observer.start()
+        return observer
+    except Exception as e:
+        print(f"无法监听下载目录，改为定时检查: {e}")
+        return None
+
+
+def _find_browser_download(output_path, export_format, download_dir):
+    """
+    检查浏览器下载是否已完成
+    
+    目标文件已存在且非空，或下载暂存目录 download_dir 中已有对应格式的文件（会被移动为目标文件）时返回 True。
+    暂存目录在每次导出前清空，其中出现的文件只可能来自本次导出。
+    """
+    # 检查目标文件是否存在
+    if output_path.exists():
+        file_size = output_path.stat().st_size
+        if file_size > 0:
+            print(f"\n✓ {export_format.upper()} 已成功下载到: {output_path}")
+            print(f"  文件大小: {file_size / 1024:.2f} KB")
+            return True
+    
+    # 查找暂存目录中已下载完成的文件（未完成的是 .crdownload）
+    all_files = list(download_dir.glob(f"*.{export_format}"))
+    if all_files:
+        latest_file = max(all_files, key=lambda p: p.stat().st_mtime)
+        print(f"  发现新下载的文件: {latest_file.name}")
+        latest_file.replace(output_path)
+        print(f"\n✓ {export_format.upper()} 已下载到: {output_path}")
+        return True
+    
+    return False
+
+
+def _clear_browser_download_dir():
+    """创建（或清空）浏览器下载暂存目录，返回其路径"""
+    BROWSER_DOWNLOAD_DIR.mkdir(parents=True, exist_ok=True)
+    for path in BROWSER_DOWNLOAD_DIR.iterdir():
+        if path.is_file():
+            try:
+                path.unlink()
+            except OSError:
+                pass
+    return BROWSER_DOWNLOAD_DIR
+
+
 def download_via_browser(gamma_url, output_path, export_format="pdf", headless=False):
     """
     使用浏览器自动化下载导出的文件
@@ -498,50 +1414,40 @@ def download_via_browser(gamma_url, output_path, export_format="pdf", headless=F
     
     返回: (success, method_used)
     """
-    if not SELENIUM_AVAILABLE:
+    if not _ensure_selenium():
         print("Selenium 未安装，无法使用浏览器自动化")
         print("请运行: pip install selenium webdriver-manager")
         return False, None
     
+    # 浏览器导出共用下载暂存目录，并发处理多个文件时逐个进行
+    with _BROWSER_EXPORT_LOCK:
+        return _download_via_browser_exclusive(gamma_url, output_path, export_format, headless)
+
+
+def _download_via_browser_exclusive(gamma_url, output_path, export_format, headless):
+    """浏览器导出的实际流程，调用方需持有 _BROWSER_EXPORT_LOCK"""
     try:
         print(f"\n{'='*60}")
         print(f"使用浏览器自动化导出 {export_format.upper()}")
         print(f"{'='*60}")
         
-        # 配置 Chrome 选项
-        chrome_options = Options()
-        if headless:
-            chrome_options.add_argument('--headless=new')  # 使用新的 headless 模式
-        chrome_options.add_argument('--no-sandbox')
-        chrome_options.add_argument('--disable-dev-shm-usage')
-        chrome_options.add_argument('--disable-gpu')
-        chrome_options.add_argument('--window-size=1920,1080')
-        
-        # 设置下载目录（使用绝对路径）
-        download_dir = str(output_path.parent.absolute())
+        # 设置下载目录（使用绝对路径）：先下载到已清空的暂存目录，完成后再移动到 output_path
+        staging_dir = _clear_browser_download_dir()
+        download_dir = str(staging_dir.absolute())
         print(f"下载目录: {download_dir}")
         
-        prefs = {
-            "download.default_directory": download_dir,
-            "download.prompt_for_download": False,
-            "download.directory_upgrade": True,
-            "safebrowsing.enabled": False,  # 禁用安全浏览以加快下载
-            "profile.default_content_setting_values.notifications": 2  # 禁用通知
-        }
-        chrome_options.add_experimental_option("prefs", prefs)
-        chrome_options.add_experimental_option("excludeSwitches", ["enable-automation"])
-        chrome_options.add_experimental_option('useAutomationExtension', False)
-        
-        # 创建 WebDriver
-        print("正在启动 Chrome 浏览器...")
+        # 创建（或复用）WebDriver
         try:
-            service = Service(ChromeDriverManager().install())
-            driver = webdriver.Chrome(service=service, options=chrome_options)
+            driver = _acquire_browser_driver(download_dir, headless)
         except Exception as e:
             print(f"启动浏览器失败: {e}")
             print("请确保已安装 Chrome 浏览器")
             return False, None
         
+        # 在触发导出之前开始监听下载目录
+        download_event = threading.Event()
+        watcher = _start_download_watcher(staging_dir, export_format, download_event)
+        
         try:
             # 访问 Gamma URL
             print(f"\n访问 Gamma URL: {gamma_url}")
@@ -691,41 +1597,33 @@ def download_via_browser(gamma_url, output_path, export_format="pdf", headless=F
             print("提示: 如果下载未自动开始，请在浏览器中手动点击导出按钮")
             
             max_wait = 120  # 增加等待时间到 2 分钟
-            waited = 0
             start_time = time.time()
+            last_report = 0
             
-            while waited < max_wait:
-                # 检查目标文件是否存在
-                if output_path.exists():
-                    file_size = output_path.stat().st_size
-                    if file_size > 0:
-                        print(f"\n✓ {export_format.upper()} 已成功下载到: {output_path}")
-                        print(f"  文件大小: {file_size / 1024:.2f} KB")
-                        return True, "browser"
-                
-                # 检查是否有临时下载文件（Chrome 的 .crdownload 文件）
-                temp_files = list(output_path.parent.glob(f"*.crdownload"))
-                if temp_files:
-                    print(f"  下载中... ({waited}秒)")
-                
-                # 查找最新的对应格式文件
-                all_files = list(output_path.parent.glob(f"*.{export_format}"))
-                if all_files:
-                    latest_file = max(all_files, key=lambda p: p.stat().st_mtime)
-                    file_age = time.time() - latest_file.stat().st_mtime
-                    if file_age < 30:  # 最近30秒内创建或修改
-                        if latest_file != output_path:
-                            print(f"  发现新下载的文件: {latest_file.name}")
-                            latest_file.rename(output_path)
-                            print(f"\n✓ {export_format.upper()} 已下载到: {output_path}")
-                            return True, "browser"
+            while time.time() - start_time < max_wait:
+                if _STOP_EVENT.is_set():
+                    print("已中断：停止等待浏览器下载")
+                    return False, None
+                download_event.clear()
+                if _find_browser_download(output_path, export_format, staging_dir):
+                    return True, "browser"
                 
-                time.sleep(2)
-                waited += 2
+                if watcher:
+                    # 目录中出现目标格式文件时立即醒来检查，否则最多等待 10 秒再检查一次
+                    remaining = max_wait - (time.time() - start_time)
+                    download_event.wait(timeout=max(0, min(10, remaining)))
+                else:
+                    _STOP_EVENT.wait(2)
                 
                 # 每 10 秒显示一次进度
-                if waited % 10 == 0:
-                    print(f"  等待中... ({waited}/{max_wait}秒)")
+                waited = int(time.time() - start_time)
+                if waited - last_report >= 10:
+                    last_report = waited
+                    # 检查是否有临时下载文件（Chrome 的 .crdownload 文件）
+                    if any(staging_dir.glob("*.crdownload")):
+                        print(f"  下载中... ({waited}秒)")
+                    else:
+                        print(f"  等待中... ({waited}/{max_wait}秒)")
             
             print(f"\n✗ 下载超时（等待 {max_wait} 秒）")
             print("提示:")
@@ -736,16 +1634,22 @@ def download_via_browser(gamma_url, output_path, export_format="pdf", headless=F
             # 如果不是 headless 模式，保持浏览器打开以便用户手动操作
             if not headless:
                 print("\n浏览器将保持打开 30 秒，您可以手动完成导出...")
-                time.sleep(30)
+                _STOP_EVENT.wait(30)
             
             return False, None
             
         finally:
-            if headless or not output_path.exists():
+            if watcher:
+                watcher.stop()
+                watcher.join()
+            if not output_path.exists():
                 driver.quit()
             else:
-                print("\n浏览器将保持打开，您可以继续操作...")
-                print("完成后请手动关闭浏览器")
+                # 下载成功：保留浏览器，后续下载直接复用
+                _release_browser_driver(driver, download_dir, headless)
+                if not headless:
+                    print("\n浏览器将保持打开，您可以继续操作...")
+                    print("完成后请手动关闭浏览器")
             
     except Exception as e:
         print(f"\n✗ 浏览器自动化失败: {e}")
@@ -778,8 +1682,8 @@ def download_pdf(gamma_url, generation_id, output_path, use_browser=False):
         return True
     
     # 方法2: 如果 API 失败且允许使用浏览器，尝试浏览器自动化
-    if use_browser or SELENIUM_AVAILABLE:
-        if SELENIUM_AVAILABLE:
+    if use_browser or _ensure_selenium():
+        if _ensure_selenium():
             print("\n方法2: API 失败，尝试使用浏览器自动化导出...")
             # 默认不使用 headless 模式，便于调试和手动操作
             headless_mode = os.getenv("BROWSER_HEADLESS", "false").lower() == "true"
@@ -822,8 +1726,8 @@ def download_pptx(gamma_url, generation_id, output_path, use_browser=False):
         return True
     
     # 方法2: 使用浏览器自动化
-    if use_browser or (not use_browser and SELENIUM_AVAILABLE):
-        if SELENIUM_AVAILABLE:
+    if use_browser or (not use_browser and _ensure_selenium()):
+        if _ensure_selenium():
             print("\n方法2: API 失败，尝试使用浏览器自动化导出...")
             success, method = download_via_browser(gamma_url, output_path, "pptx", headless=True)
             if success:
@@ -836,6 +1740,108 @@ def download_pptx(gamma_url, generation_id, output_path, use_browser=False):
     return False
 
 
+def _ensure_token_vocab_cached():
+    """
+    确保 tiktoken 的词表已在本地缓存中，没有时带超时下载到 tiktoken 的缓存目录
+    
+    缓存目录和文件名与 tiktoken 自身的规则一致（TIKTOKEN_CACHE_DIR / DATA_GYM_CACHE_DIR /
+    系统临时目录下的 data-gym-cache，文件名为词表地址的 sha1），之后 tiktoken 直接读取缓存，
+    不会再发起没有超时的下载。缓存被禁用（目录设为空）时无法保证这一点，抛出异常。
+    """
+    cache_dir = os.environ.get("TIKTOKEN_CACHE_DIR",
+                               os.environ.get("DATA_GYM_CACHE_DIR",
+                                              os.path.join(tempfile.gettempdir(), "data-gym-cache")))
+    if not cache_dir:
+        raise RuntimeError("tiktoken 缓存已被禁用，无法预先下载词表")
+    cache_path = Path(cache_dir) / hashlib.sha1(TOKEN_ENCODING_URL.encode()).hexdigest()
+    if cache_path.exists():
+        return
+    print("正在下载 tiktoken 词表...")
+    # 词表与 Gamma API 无关，请求中去掉会话默认携带的 X-API-KEY
+    response = _SESSION.get(TOKEN_ENCODING_URL, headers={"X-API-KEY": None},
+                            timeout=TOKEN_ENCODING_TIMEOUT)
+    response.raise_for_status()
+    cache_path.parent.mkdir(parents=True, exist_ok=True)
+    _write_file_atomic(cache_path, response.content)
+
+
+def _get_token_encoding():
+    """
+    获取 tiktoken 编码器，不可用时返回 None
+    
+    加载失败（例如无法在超时内下载词表）后不再重试，之后都按字符数估算。
+    加锁保证并发处理多个文件时只加载（下载）一次。
+    """
+    global _token_encoding, TIKTOKEN_AVAILABLE
+    if _token_encoding is not None or not TIKTOKEN_AVAILABLE:
+        return _token_encoding
+    with _TOKEN_ENCODING_LOCK:
+        if _token_encoding is None and TIKTOKEN_AVAILABLE:
+            try:
+                _ensure_token_vocab_cached()
+                _token_encoding = tiktoken.get_encoding(TOKEN_ENCODING_NAME)
+            except Exception as e:
+                print(f"加载 tiktoken 编码失败，改为按字符数估算文本长度: {e}")
+                TIKTOKEN_AVAILABLE = False
+    return _token_encoding
+
+
+def _truncate_to_token_limit(text, suffix=""):
+    """
+    将 text + suffix 截断到 MAX_INPUT_TOKENS 以内，只截断 text，suffix 始终完整保留
+    
+    tiktoken 可用时按 token 数精确截断（中文等每个字符约占一个或多个 token，
+    按 4 字符估算会明显低估）；否则按 MAX_INPUT_CHARS 字符截断。
+    
+    返回: (text + suffix, truncated)
+    """
+    # 每个 token 至少对应 1 个 UTF-8 字节：字节数不超过上限时无需分词，也无需加载编码器
+    if (len(text) + len(suffix) <= MAX_INPUT_TOKENS
+            and len(text.encode('utf-8')) + len(suffix.encode('utf-8')) <= MAX_INPUT_TOKENS):
+        return text + suffix, False
+    
+    encoding = _get_token_encoding()
+    if encoding is None:
+        max_chars = max(0, MAX_INPUT_CHARS - len(suffix))
+        if len(text) <= max_chars:
+            return text + suffix, False
+        return text[:max_chars] + suffix, True
+    
+    max_tokens = max(0, MAX_INPUT_TOKENS - len(encoding.encode_ordinary(suffix)))
+    tokens = encoding.encode_ordinary(text)
+    if len(tokens) <= max_tokens:
+        return text + suffix, False
+    # 截断处可能落在多字节字符中间，丢弃不完整的字节
+    return encoding.decode(tokens[:max_tokens], errors="ignore") + suffix, True
+
+
+def _image_scan_spans(text):
+    """
+    返回查找图片链接的文本区间 [(start, end), ...]
+    
+    超长文本只查找开头和结尾各 IMAGE_SCAN_EDGE_CHARS 个字符（引用的图片通常集中在这两处），
+    通过正则的 pos/endpos 参数限定范围，不复制文本。
+    """
+    if len(text) <= 2 * IMAGE_SCAN_EDGE_CHARS:
+        return [(0, len(text))]
+    return [(0, IMAGE_SCAN_EDGE_CHARS), (len(text) - IMAGE_SCAN_EDGE_CHARS, len(text))]
+
+
+def _output_path_for(input_path):
+    """
+    返回输入文件对应的输出 PDF 路径
+    
+    默认为 <文件名>_gamma_presentation.pdf；只有非 .docx 输入旁边存在同名的 .docx 时，
+    才在文件名后附加扩展名（例如 foo.pdf → foo_pdf_gamma_presentation.pdf），
+    避免 foo.docx 和 foo.pdf 写入同一个文件，其余情况保持原有的输出文件名。
+    """
+    input_path = Path(input_path)
+    suffix = input_path.suffix.lower()
+    if suffix != ".docx" and input_path.with_suffix(".docx").exists():
+        return OUTPUT_DIR / f"{input_path.stem}_{suffix.lstrip('.')}_gamma_presentation.pdf"
+    return OUTPUT_DIR / f"{input_path.stem}_gamma_presentation.pdf"
+
+
 def process_file(input_file_path, force_regenerate=False):
     """
     处理单个文件：提取文本、生成 PPT、下载 PDF
@@ -846,15 +1852,19 @@ def process_file(input_file_path, force_regenerate=False):
     """
     input_path = Path(input_file_path)
     
-    if not input_path.exists():
+    # 路径解析和 stat 只做一次，结果传给后续的记录查询和保存
+    try:
+        resolved_path = input_path.resolve()
+        file_stat = resolved_path.stat()
+    except OSError:
         print(f"文件不存在: {input_path}")
         return False
     
     print(f"\n处理文件: {input_path.name}")
     
-    # 检查是否已经生成过
+    # 检查是否已经生成过（文件未变化时按路径直接命中，不读取文件内容）
     if not force_regenerate:
-        exists, record = check_existing_generation(input_path)
+        exists, record = check_existing_generation(input_path, resolved=resolved_path, st=file_stat)
         if exists:
             print(f"\n发现已存在的生成记录:")
             print(f"  生成 ID: {record.get('generation_id', 'N/A')}")
@@ -867,9 +1877,12 @@ def process_file(input_file_path, force_regenerate=False):
                 print(f"\n使用已存在的生成结果:")
                 print(f"  URL: {gamma_url}")
                 
-                # 尝试下载 PDF（如果之前没有下载成功）
-                output_filename = input_path.stem + "_gamma_presentation.pdf"
-                output_path = OUTPUT_DIR / output_filename
+                # 尝试下载 PDF（如果之前没有下载成功）；记录中保存的 pdf_path 优先，
+                # 这样输出命名规则变化后也不会重复导出已下载过的文件
+                output_path = _output_path_for(input_path)
+                recorded_path = record.get('pdf_path')
+                if recorded_path and Path(recorded_path).is_file():
+                    output_path = Path(recorded_path)
                 
                 if not output_path.exists():
                     print("尝试下载 PDF...")
@@ -882,6 +1895,10 @@ def process_file(input_file_path, force_regenerate=False):
             else:
                 print("警告: 记录中没有 Gamma URL，将重新生成")
     
+    # 需要重新生成：提取文本的同时在后台预热 API 主机的连接，
+    # 调用 generate_presentation 时无需再等待 TCP/TLS 握手
+    _warm_connection(f"{GAMMA_API_BASE_URL}/")
+    
     # 提取文本内容和图片链接
     image_urls = []
     if input_path.suffix.lower() == ".docx":
@@ -892,11 +1909,9 @@ def process_file(input_file_path, force_regenerate=False):
         text_content, image_urls = result
     elif input_path.suffix.lower() == ".pdf":
         text_content = extract_text_from_pdf(input_path)
-        # PDF 中的图片链接提取（简单版本）
+        # PDF 中的图片链接提取（简单版本）；同一图片常在多页重复出现，按首次出现顺序去重
         if text_content:
-            import re
-            urls = re.findall(r'https?://[^\s<>"{}|\\^`\[\]]+', text_content)
-            image_urls = [url for url in urls if any(url.lower().endswith(ext) for ext in ['.jpg', '.jpeg', '.png', '.gif', '.webp', '.svg'])]
+            image_urls = _find_image_urls(text_content, _is_pdf_image_url, _image_scan_spans(text_content))
     else:
         print(f"不支持的文件格式: {input_path.suffix}")
         return False
@@ -908,19 +1923,23 @@ def process_file(input_file_path, force_regenerate=False):
     print(f"已提取文本内容，长度: {len(text_content)} 字符")
     
     # 处理图片 URL（根据官方文档，可以在 inputText 中直接插入图片 URL）
+    image_section = ""
     if image_urls:
         print(f"找到 {len(image_urls)} 个图片链接")
-        # 在文本末尾添加图片 URL（根据官方文档，Gamma 会自动识别并处理）
-        image_section = "\n\n---\n\n# 图片资源\n"
-        for i, img_url in enumerate(image_urls[:20], 1):  # 限制最多20张图片
-            image_section += f"{img_url}\n"
-        text_content += image_section
-        print("已将图片链接添加到输入文本中")
+        # 一次 join 拼出图片资源部分，不逐个追加产生中间字符串
+        image_section = "".join([
+            "\n\n---\n\n# 图片资源\n",
+            *(f"{img_url}\n" for img_url in image_urls[:MAX_IMAGE_URLS]),  # 限制最多20张图片
+        ])
     
     # 检查文本长度（Gamma API 限制约 100,000 tokens）
-    if len(text_content) > 400000:  # 粗略估算，1 token ≈ 4 字符
-        print("警告: 文本内容可能超过 API 限制，将截断")
-        text_content = text_content[:400000]
+    # 在文本末尾添加图片 URL（根据官方文档，Gamma 会自动识别并处理）；
+    # 截断时只截断正文，图片资源部分完整保留
+    text_content, truncated = _truncate_to_token_limit(text_content, image_section)
+    if truncated:
+        print("警告: 文本内容可能超过 API 限制，已截断")
+    if image_section:
+        print("已将图片链接添加到输入文本中")
     
     # 调用 Gamma API 生成演示文稿
     # 如果设置了 GAMMA_THEME_ID 环境变量则使用，否则使用工作区默认主题
@@ -939,7 +1958,9 @@ def process_file(input_file_path, force_regenerate=False):
     if not generation_id:
         return False
     
-    # 等待生成完成
+    # 等待生成完成；轮询的同时预热导出备用端点所在主机的连接，
+    # 生成完成后下载时无需再等待握手
+    _warm_connection(f"{GAMMA_APP_BASE_URL}/")
     success, result = wait_for_completion(generation_id)
     
     if not success:
@@ -955,12 +1976,15 @@ def process_file(input_file_path, force_regenerate=False):
     print(f"Gamma URL: {gamma_url}")
     
     # 保存生成记录
-    add_generation_record(input_path, generation_id, gamma_url, "completed")
+    # 文件哈希已在查询记录时缓存，这里不会重复读取文件
+    add_generation_record(input_path, generation_id, gamma_url, "completed",
+                          resolved=resolved_path, st=file_stat)
+    # 立即落盘：下载（尤其是浏览器导出）可能耗时数分钟，期间断电也不能丢失这条已付费生成的记录
+    sync_records_log()
     print("已保存生成记录")
     
     # 生成输出文件名
-    output_filename = input_path.stem + "_gamma_presentation.pdf"
-    output_path = OUTPUT_DIR / output_filename
+    output_path = _output_path_for(input_path)
     
     # 下载 PDF（传入 generation_id 用于 API 调用）
     # 检查是否使用浏览器自动化
@@ -972,14 +1996,132 @@ def process_file(input_file_path, force_regenerate=False):
         update_generation_record(generation_id, pdf_downloaded=True, pdf_path=str(output_path))
     else:
         update_generation_record(generation_id, pdf_downloaded=False)
+    # 下载结果（pdf_downloaded）的更新同样落盘
+    sync_records_log()
     
     return download_success
 
 
+def process_files(file_paths, force_regenerate=False, max_workers=None):
+    """
+    并发处理多个文件
+    
+    每个文件的流程（生成、轮询状态、下载）大部分时间都在等待 Gamma API，
+    使用线程池让多个文件的等待相互重叠；max_workers 限制同时进行的任务数。
+    
+    参数:
+    - file_paths: 输入文件路径列表
+    - force_regenerate: 是否强制重新生成（即使已存在记录）
+    - max_workers: 最大并发数（默认 MAX_CONCURRENT_FILES）
+    
+    返回: {文件路径: 是否成功}
+    """
+    file_paths = list(file_paths)
+    if not file_paths:
+        return {}
+    
+    # 输出路径相同的文件（例如 foo.docx 和 foo.DOCX）放在同一个任务中依次处理，
+    # 不会有两个线程同时写入同一个输出文件
+    groups = {}
+    for file_path in file_paths:
+        groups.setdefault(_output_path_for(file_path), []).append(file_path)
+    
+    def process_group(group):
+        group_results = {}
+        for file_path in group:
+            if _STOP_EVENT.is_set():
+                group_results[file_path] = False
+                continue
+            try:
+                group_results[file_path] = process_file(file_path, force_regenerate=force_regenerate)
+            except Exception as e:
+                print(f"处理文件 {Path(file_path).name} 时出错: {e}")
+                group_results[file_path] = False
+        return group_results
+    
+    max_workers = max(1, min(max_workers or MAX_CONCURRENT_FILES, len(groups)))
+    results = {}
+    executor = ThreadPoolExecutor(max_workers=max_workers)
+    try:
+        futures = [executor.submit(process_group, group) for group in groups.values()]
+        for future in as_completed(futures):
+            results.update(future.result())
+    except KeyboardInterrupt:
+        # 不等待正在运行的任务（可能正处于数分钟的轮询中）：取消尚未开始的任务，
+        # 并通过 _STOP_EVENT 让运行中的任务在下一次等待时立即返回
+        print("\n已中断，正在停止其余任务...")
+        _STOP_EVENT.set()
+        executor.shutdown(wait=False, cancel_futures=True)
+        raise
+    executor.shutdown()
+    return results
+
+
+# 命令行参数（长短两种写法）
+FLAGS_LIST = frozenset(("--list", "-l"))
+FLAGS_FORCE = frozenset(("--force", "-f"))
+FLAGS_BROWSER = frozenset(("--browser", "-b"))
+FLAGS_ALL = frozenset(("--all", "-a"))
+
+
+def _iter_dataset_files():
+    """
+    按目录遍历顺序逐个产出 dataset 目录下的 (扩展名, 路径)，扩展名为 ".docx" 或 ".pdf"
+    
+    调用方提前停止迭代时，目录的其余部分不会再被读取。
+    """
+    try:
+        with os.scandir(DATASET_DIR) as entries:
+            for entry in entries:
+                name = entry.name.lower()
+                if name.endswith(".docx"):
+                    suffix = ".docx"
+                elif name.endswith(".pdf"):
+                    suffix = ".pdf"
+                else:
+                    continue
+                if entry.is_file():
+                    yield suffix, Path(entry.path)
+    except FileNotFoundError:
+        return
+
+
+def _scan_dataset():
+    """
+    一次遍历 dataset 目录，按扩展名分出 .docx 和 .pdf 文件
+    
+    返回: (docx_files, pdf_files)，保持目录遍历顺序
+    """
+    docx_files = []
+    pdf_files = []
+    for suffix, path in _iter_dataset_files():
+        (docx_files if suffix == ".docx" else pdf_files).append(path)
+    return docx_files, pdf_files
+
+
+def _find_default_target():
+    """
+    查找未指定 --all 时要处理的文件
+    
+    优先处理文件名包含“原始邮件数据”的 .docx 文件，找到后立即停止遍历目录；
+    目录中没有任何 .docx 文件时，处理第一个 PDF 文件。
+    
+    返回: (target, has_docx)，没有可处理的文件时 target 为 None
+    """
+    has_docx = False
+    first_pdf = None
+    for suffix, path in _iter_dataset_files():
+        if suffix == ".docx":
+            has_docx = True
+            if "原始邮件数据" in path.name:
+                return path, True
+        elif first_pdf is None:
+            first_pdf = path
+    return (None if has_docx else first_pdf), has_docx
+
+
 def main():
     """主函数"""
-    import sys
-    
     print("=" * 50)
     print("Gamma API 演示文稿生成工具")
     print("=" * 50)
@@ -987,16 +2129,19 @@ def main():
     # 检查命令行参数
     force_regenerate = False
     use_browser = False
+    process_all = False
     
     if len(sys.argv) > 1:
         for arg in sys.argv[1:]:
-            if arg == "--list" or arg == "-l":
+            if arg in FLAGS_LIST:
                 list_generations()
                 return
-            elif arg == "--force" or arg == "-f":
+            elif arg in FLAGS_FORCE:
                 force_regenerate = True
-            elif arg == "--browser" or arg == "-b":
+            elif arg in FLAGS_BROWSER:
                 use_browser = True
+            elif arg in FLAGS_ALL:
+                process_all = True
             else:
                 print(f"未知参数: {arg}")
                 print("\n用法:")
@@ -1004,6 +2149,7 @@ def main():
                 print("  python main.py --force     # 强制重新生成")
                 print("  python main.py --list      # 列出所有生成记录")
                 print("  python main.py --browser   # 使用浏览器自动化导出")
+                print("  python main.py --all       # 并发处理 dataset 目录下的所有文件")
                 print("  python main.py --force --browser  # 强制重新生成并使用浏览器导出")
                 return
     
@@ -1017,26 +2163,31 @@ def main():
         print("可以在 .env 文件中设置，或使用环境变量")
         return
     
-    # 查找 dataset 目录下的文件
-    docx_files = list(DATASET_DIR.glob("*.docx"))
-    pdf_files = list(DATASET_DIR.glob("*.pdf"))
-    
-    # 优先处理 .docx 文件（原始邮件数据）
-    if docx_files:
-        print(f"\n找到 {len(docx_files)} 个 .docx 文件")
-        for docx_file in docx_files:
-            if "原始邮件数据" in docx_file.name:
-                process_file(docx_file, force_regenerate=force_regenerate)
-                break
-    elif pdf_files:
-        print(f"\n找到 {len(pdf_files)} 个 PDF 文件")
-        # 如果 Gamma 不支持 PDF，这里可以提取文本后处理
-        print("注意: Gamma API 不支持直接 PDF 输入，将提取文本内容")
-        for pdf_file in pdf_files:
-            process_file(pdf_file, force_regenerate=force_regenerate)
-            break
+    if process_all:
+        docx_files, pdf_files = _scan_dataset()
+        all_files = docx_files + pdf_files
+        if all_files:
+            print(f"\n找到 {len(docx_files)} 个 .docx 文件，{len(pdf_files)} 个 PDF 文件")
+            print(f"将并发处理所有文件（最多同时处理 {MAX_CONCURRENT_FILES} 个）")
+            results = process_files(all_files, force_regenerate=force_regenerate)
+            print(f"\n成功处理 {sum(1 for ok in results.values() if ok)}/{len(results)} 个文件")
+        else:
+            print("未找到可处理的文件（.docx 或 .pdf）")
     else:
-        print("未找到可处理的文件（.docx 或 .pdf）")
+        # 优先处理 .docx 文件（原始邮件数据）
+        target, has_docx = _find_default_target()
+        if target is not None and target.suffix.lower() == ".docx":
+            print(f"\n找到 .docx 文件: {target.name}")
+            process_file(target, force_regenerate=force_regenerate)
+        elif target is not None:
+            print(f"\n找到 PDF 文件: {target.name}")
+            # 如果 Gamma 不支持 PDF，这里可以提取文本后处理
+            print("注意: Gamma API 不支持直接 PDF 输入，将提取文本内容")
+            process_file(target, force_regenerate=force_regenerate)
+        elif has_docx:
+            print("\n未找到文件名包含“原始邮件数据”的 .docx 文件")
+        else:
+            print("未找到可处理的文件（.docx 或 .pdf）")
     
     print("\n处理完成！")
     print(f"\n提示: 使用 'python main.py --list' 查看所有生成记录")